@@ -1,224 +1,910 @@
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify, send_file, Response, stream_with_context
 from flask_cors import CORS
+from cachetools import LRUCache
+from werkzeug.exceptions import RequestEntityTooLarge
+import orjson
 import subprocess
 import os
 import tempfile
 import json
 import threading
+import queue
+import struct
+import hashlib
+import time
+import functools
+import shutil
+import atexit
+import logging
+import logging.handlers
 from pathlib import Path
 import sys
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
 
+# Log through a queue so request threads never block on stream writes
+_log_queue = queue.Queue(-1)
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_handler)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+log = logging.getLogger('moonsec')
+log.addHandler(logging.handlers.QueueHandler(_log_queue))
+log.setLevel(os.environ.get("MOONSEC_LOG_LEVEL", "INFO").upper())
+log.propagate = False
+
+# Reject oversized bodies before they are read
+MAX_REQUEST_BYTES = 4 * 1024 * 1024
+# UTF-8 size of the Lua source itself; below the body cap to leave room
+# for JSON escaping and the other fields
+MAX_LUA_BYTES = 2 * 1024 * 1024
+app.config['MAX_CONTENT_LENGTH'] = MAX_REQUEST_BYTES
+
 # Configuration
 MOONSEC_PATH = Path("MoonsecDeobfuscator-master")
 BUILD_PATH = MOONSEC_PATH / "bin" / "Release" / "net8.0"
+# subprocess only takes the posix_spawn fast path (instead of fork+exec) for
+# an executable with a directory part, no cwd and close_fds=False. Python's
+# own descriptors are non-inheritable (PEP 446), so close_fds=False is safe.
+DOTNET = shutil.which("dotnet") or "dotnet"
+WORKER_COUNT = int(os.environ.get("MOONSEC_WORKERS", "2"))
+JOB_TIMEOUT = 30
+# How long to use one-shot runs before retrying a worker pool that failed to start
+WORKER_RETRY_SECONDS = 60
+# How long the dll must be unchanged before an outside rebuild is picked up
+BUILD_SETTLE_SECONDS = 2
+# Pipe source/output through stdin/stdout (`-i - -o -`) instead of temp files.
+# Opt-in: only builds of the tool that accept `-` as a path support this
+USE_STDIO = os.environ.get("MOONSEC_USE_STDIO", "0") == "1"
+# Reusable temp files for the file-path fallback, in a private directory
+# created under tmpfs where available
+TEMP_POOL_SIZE = 8
+TEMP_POOL_PARENT = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+HEALTH_TTL = 30
+CACHE_SIZE = 512
+CACHE_MAX_CONTENT = 1 << 20
+# Results above this size are streamed rather than encoded in one buffer
+STREAM_THRESHOLD = 1 << 20
+STREAM_CHUNK = 64 * 1024
+
+# Worker job flags
+FLAG_DISASSEMBLY = 0x01
+FLAG_PRETTY = 0x02
+FLAG_PING = 0x04
+
+class MoonsecWorker:
+    """A long-lived `--serve` process of the Moonsec tool
+
+    Jobs are framed as `<BI` (flags, length) followed by the Lua source;
+    replies are `<BI` (status, length) followed by the output. A job with
+    FLAG_PING set is a ping; its reply lists the worker's capabilities
+    (e.g. `pretty`) separated by whitespace, and may be empty.
+    """
+
+    def __init__(self, exe_argv):
+        self.exe_argv = exe_argv
+        self.lock = threading.Lock()
+        self.proc = None
+        self.closed = False
+        # Guards proc/closed so a closed worker is never restarted
+        self._proc_lock = threading.Lock()
+
+    def alive(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def start(self):
+        self.proc = subprocess.Popen(
+            self.exe_argv + ["--serve"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            bufsize=0,
+            close_fds=False
+        )
+
+    def stop(self, close=False):
+        with self._proc_lock:
+            self.closed = self.closed or close
+            if self.proc is not None:
+                try:
+                    self.proc.kill()
+                    self.proc.wait(timeout=5)
+                except Exception:
+                    pass
+                self.proc = None
+
+    @staticmethod
+    def _read_exact(proc, size):
+        chunks = []
+        while size:
+            chunk = proc.stdout.read(size)
+            if not chunk:
+                raise EOFError("Worker exited unexpectedly")
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b"".join(chunks)
+
+    def run(self, flags, payload, timeout=JOB_TIMEOUT):
+        """Send one job and return (status, output). Caller must hold self.lock"""
+        with self._proc_lock:
+            if self.closed:
+                raise RuntimeError("Worker pool is closed")
+            if not self.alive():
+                self.start()
+            proc = self.proc
+        
+        # Kill the worker if the job overruns; the blocked read then fails
+        expired = threading.Event()
+        def on_timeout():
+            expired.set()
+            proc.kill()
+        
+        timer = threading.Timer(timeout, on_timeout)
+        timer.start()
+        try:
+            proc.stdin.write(struct.pack("<BI", flags, len(payload)) + payload)
+            status, length = struct.unpack("<BI", self._read_exact(proc, 5))
+            output = self._read_exact(proc, length)
+        except (OSError, EOFError, struct.error):
+            self.stop()
+            if expired.is_set():
+                raise subprocess.TimeoutExpired(self.exe_argv, timeout)
+            raise
+        finally:
+            timer.cancel()
+        
+        return status, output
+
+class Job:
+    """A deobfuscation job waiting in the pool's queue"""
+
+    def __init__(self, flags, payload):
+        self.flags = flags
+        self.payload = payload
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.cancelled = False
+
+class WorkerPool:
+    """Fixed set of Moonsec workers fed from a shared job queue
+
+    Each worker has a dispatcher thread that takes one queued job at a time,
+    so concurrent requests share the persistent workers instead of each
+    spawning the tool.
+    """
+
+    def __init__(self, exe_argv, size=WORKER_COUNT):
+        self.exe_argv = exe_argv
+        self.workers = [MoonsecWorker(exe_argv) for _ in range(max(1, size))]
+        self.jobs = queue.Queue()
+        self.capabilities = frozenset()
+        self.closed = False
+        # Orders close() after every accepted job in the queue
+        self._close_lock = threading.Lock()
+        for worker in self.workers:
+            threading.Thread(target=self._dispatch, args=(worker,), daemon=True).start()
+
+    def _dispatch(self, worker):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                # Sentinels follow every accepted job, so nothing is left for this worker
+                worker.stop(close=True)
+                return
+            if job.cancelled:
+                continue
+            
+            with worker.lock:
+                try:
+                    job.result = worker.run(job.flags, job.payload)
+                except Exception as e:
+                    job.error = e
+            job.done.set()
+
+    def run(self, flags, payload):
+        job = Job(flags, payload)
+        with self._close_lock:
+            if self.closed:
+                raise RuntimeError("Worker pool is closed")
+            self.jobs.put(job)
+        
+        if not job.done.wait(timeout=JOB_TIMEOUT):
+            job.cancelled = True
+            raise subprocess.TimeoutExpired(self.exe_argv, JOB_TIMEOUT)
+        if job.error is not None:
+            raise job.error
+        return job.result
 
+    def ping(self):
+        """Ping an idle worker; a fully busy pool counts as healthy"""
+        for worker in self.workers:
+            if worker.lock.acquire(blocking=False):
+                try:
+                    status, output = worker.run(FLAG_PING, b"", timeout=5)
+                except Exception:
+                    return False
+                finally:
+                    worker.lock.release()
+                
+                if status != 0:
+                    return False
+                self.capabilities = frozenset(output.decode('ascii', 'ignore').split())
+                return True
+        return True
+
+    def close(self, drain=False):
+        """Refuse new jobs and shut the workers down
+
+        With `drain`, jobs already queued or running finish first and each
+        dispatcher stops its worker once it reaches its sentinel.
+        """
+        with self._close_lock:
+            self.closed = True
+            # One sentinel per dispatcher thread, queued behind any pending jobs
+            for worker in self.workers:
+                self.jobs.put(None)
+        if drain:
+            return
+        # Closed workers refuse the jobs still queued rather than respawning
+        for worker in self.workers:
+            worker.stop(close=True)
+
+_worker_pool = None
+_worker_pool_argv = None
+_worker_pool_failed_at = None
+_worker_pool_lock = threading.Lock()
+
+def get_worker_pool(exe_argv, restart=False):
+    """Return a started worker pool, or None if the tool has no `--serve` mode
+
+    A pool that fails its startup ping is retried after WORKER_RETRY_SECONDS,
+    so a slow cold start doesn't disable workers for good.
+    """
+    global _worker_pool, _worker_pool_argv, _worker_pool_failed_at
+    
+    if exe_argv is None:
+        return None
+    
+    with _worker_pool_lock:
+        if _worker_pool_argv == exe_argv and not restart:
+            if _worker_pool is not None:
+                return _worker_pool
+            if (_worker_pool_failed_at is not None
+                    and time.monotonic() - _worker_pool_failed_at < WORKER_RETRY_SECONDS):
+                return None
+        
+        old_pool = _worker_pool
+        pool = WorkerPool(exe_argv)
+        if pool.ping():
+            _worker_pool_failed_at = None
+        else:
+            # Tool predates the job protocol or didn't start in time; use one-shot runs
+            pool.close()
+            pool = None
+            _worker_pool_failed_at = time.monotonic()
+        
+        _worker_pool, _worker_pool_argv = pool, exe_argv
+        if old_pool is not None:
+            # New requests already go to the new pool; let in-flight ones finish
+            old_pool.close(drain=True)
+        return pool
+
+# Results keyed by (content digest, disassembly, pretty)
+_result_cache = LRUCache(maxsize=CACHE_SIZE)
+_result_cache_lock = threading.Lock()
+_cache_stats = {"hits": 0, "misses": 0}
+
+# argv prefix that runs the built tool, resolved once per build
+EXE_ARGV = None
+
+def _resolve_exe():
+    """Find the built Moonsec tool and return the argv prefix to run it"""
+    # One directory listing instead of a stat() per candidate
+    try:
+        with os.scandir(BUILD_PATH) as entries:
+            names = {entry.name for entry in entries}
+    except FileNotFoundError:
+        names = set()
+    
+    for name in ("MoonsecDeobfuscator.exe",  # Windows
+                 "MoonsecDeobfuscator"):     # Linux/Mac
+        if name in names:
+            return [str(BUILD_PATH / name)]
+    
+    # Try dotnet run as fallback
+    if "MoonsecDeobfuscator.dll" in names:
+        return [DOTNET, str(BUILD_PATH / "MoonsecDeobfuscator.dll")]
+    
+    raise FileNotFoundError("Moonsec executable not found. Try building first.")
+
+def _build_mtime():
+    """mtime of the built tool, or None if it hasn't been built
+
+    Keyed on the dll because in-place rebuilds overwrite it (and not
+    necessarily the apphost) without touching the directory.
+    """
+    for path in (BUILD_PATH / "MoonsecDeobfuscator.dll", EXE_ARGV and EXE_ARGV[-1]):
+        if path:
+            try:
+                return os.stat(path).st_mtime_ns
+            except FileNotFoundError:
+                pass
+    return None
+
+# Changes whenever the tool is rebuilt; part of every ETag
+BUILD_STAMP = 0
+# Guards EXE_ARGV and the state derived from it
+_exe_lock = threading.RLock()
+# _build_mtime() when EXE_ARGV was last resolved
+_exe_mtime = None
+
+# Whether /deobfuscate can run the tool, and why not if it can't
+_READY = False
+_READY_MSG = None
+
+def refresh_exe():
+    """Re-resolve EXE_ARGV and readiness; None if the tool has not been built
+
+    If the build changed since the last call, a new worker pool is started
+    on the new binaries (the old one drains) and cached results from the old
+    build are dropped.
+    """
+    global EXE_ARGV, BUILD_STAMP, _exe_mtime
+    with _exe_lock:
+        try:
+            EXE_ARGV = _resolve_exe()
+        except FileNotFoundError:
+            EXE_ARGV = None
+        
+        mtime = _build_mtime()
+        changed = mtime != _exe_mtime
+        _exe_mtime = mtime
+        BUILD_STAMP = mtime or 0
+        update_readiness()
+        
+        if changed:
+            with _result_cache_lock:
+                _result_cache.clear()
+            if EXE_ARGV is not None and _worker_pool is not None:
+                # Workers are still running the old binaries
+                get_worker_pool(EXE_ARGV, restart=True)
+        return EXE_ARGV
+
+def get_exe_argv():
+    """EXE_ARGV, re-resolved when the built tool changes
+
+    Picks up builds made outside the server for the cost of one stat(),
+    but only once the dll has settled: changes seen while our own build
+    runs are left to that build, and a dll still being written is ignored.
+    """
+    mtime = _build_mtime()
+    if mtime != _exe_mtime and _build_settled(mtime):
+        with _exe_lock:
+            # Another request may have handled the change while we waited
+            if _build_mtime() == mtime != _exe_mtime:
+                refresh_exe()
+    return EXE_ARGV
+
+def _build_settled(mtime):
+    if _build_lock.locked():
+        return False
+    return mtime is None or time.time_ns() - mtime >= BUILD_SETTLE_SECONDS * 1_000_000_000
+
+def update_readiness():
+    """Recompute _READY so doomed requests fail without spawning the tool"""
+    global _READY, _READY_MSG
+    
+    if not MOONSEC_PATH.exists():
+        _READY_MSG = f"MoonsecDeobfuscator not found at: {MOONSEC_PATH}"
+    elif not check_dotnet():
+        _READY_MSG = ".NET SDK not found. Please install .NET 8.0+"
+    elif EXE_ARGV is None:
+        _READY_MSG = "Moonsec executable not found. Try building first."
+    else:
+        _READY_MSG = None
+    _READY = _READY_MSG is None
+
+@functools.lru_cache(maxsize=1)
 def check_dotnet():
     """Check if .NET is available"""
     try:
-        result = subprocess.run(["dotnet", "--version"], 
+        result = subprocess.run([DOTNET, "--version"], 
                               capture_output=True, 
                               text=True, 
-                              timeout=5)
+                              timeout=5,
+                              close_fds=False)
         return result.returncode == 0
     except:
         return False
 
-def build_moonsec():
-    """Build the Moonsec tool"""
+refresh_exe()
+
+def build_is_stale():
+    """True if the build is missing or older than any project/source file"""
+    dll_path = BUILD_PATH / "MoonsecDeobfuscator.dll"
+    if not dll_path.exists():
+        return True
+    
+    built = dll_path.stat().st_mtime
+    for pattern in ("*.csproj", "*.cs"):
+        for path in MOONSEC_PATH.rglob(pattern):
+            if path.relative_to(MOONSEC_PATH).parts[0] in ("bin", "obj"):
+                continue
+            if path.stat().st_mtime > built:
+                return True
+    return False
+
+class BuildInProgress(Exception):
+    """Raised when a build is requested while another one is running"""
+
+# Only one dotnet build/clean may touch the project at a time
+_build_lock = threading.Lock()
+
+def build_moonsec(force=False, clean=False):
+    """Build the Moonsec tool
+
+    Up-to-date builds are skipped unless `force` is set; MSBuild's
+    incremental build handles partial staleness, so `clean` is only for
+    explicit full rebuilds. Raises BuildInProgress if a build is running.
+    """
+    if not _build_lock.acquire(blocking=False):
+        raise BuildInProgress("A Moonsec build is already running")
+    
     try:
-        print("🔨 Building Moonsec Deobfuscator...")
+        return _build_moonsec(force, clean)
+    finally:
+        _build_lock.release()
+
+def _build_moonsec(force, clean):
+    try:
+        if not force and not build_is_stale():
+            log.info("✅ Moonsec build is up to date")
+            refresh_exe()
+            return True
         
-        # Clean and build
-        result = subprocess.run(
-            ["dotnet", "clean", "-c", "Release"],
-            cwd=str(MOONSEC_PATH),
-            capture_output=True,
-            text=True
-        )
+        log.info("🔨 Building Moonsec Deobfuscator...")
+        
+        if clean:
+            subprocess.run(
+                [DOTNET, "clean", str(MOONSEC_PATH), "-c", "Release"],
+                capture_output=True,
+                text=True,
+                close_fds=False
+            )
         
+        # Pass the project directory rather than cwd= to keep posix_spawn
         result = subprocess.run(
-            ["dotnet", "build", "-c", "Release"],
-            cwd=str(MOONSEC_PATH),
+            [DOTNET, "build", str(MOONSEC_PATH), "-c", "Release"],
             capture_output=True,
-            text=True
+            text=True,
+            close_fds=False
         )
         
         if result.returncode == 0:
-            print("✅ Build successful!")
+            log.info("✅ Build successful!")
+            refresh_exe()
             return True
         else:
-            print(f"❌ Build failed: {result.stderr}")
+            log.error("❌ Build failed: %s", result.stderr)
             return False
             
     except Exception as e:
-        print(f"❌ Build error: {e}")
+        log.error("❌ Build error: %s", e)
         return False
 
+# Set once the startup build has finished, successfully or not
+BUILD_READY = threading.Event()
+
+def background_build():
+    """Build at import so the first request doesn't pay for it"""
+    try:
+        if build_moonsec() and EXE_ARGV is not None:
+            # Warm the workers so the first request skips CLR startup
+            get_worker_pool(EXE_ARGV)
+    except BuildInProgress:
+        # A /rebuild got there first and will refresh the executable itself
+        pass
+    finally:
+        BUILD_READY.set()
+
+if BUILD_PATH.exists() or not MOONSEC_PATH.exists():
+    # Serve the existing build (or report the missing tool) right away
+    BUILD_READY.set()
+
+if MOONSEC_PATH.exists():
+    threading.Thread(target=background_build, daemon=True).start()
+
+# Static bodies, encoded once at import
+_INDEX_BODY = orjson.dumps({
+    "name": "Moonsec Deobfuscator API",
+    "version": "1.0.0",
+    "status": "running"
+})
+
 @app.route('/')
 def index():
     """Home page"""
-    return jsonify({
-        "name": "Moonsec Deobfuscator API",
-        "version": "1.0.0",
-        "status": "running"
-    })
+    return Response(_INDEX_BODY, mimetype='application/json')
 
-@app.route('/health', methods=['GET'])
-def health():
-    """Health check endpoint"""
-    dotnet_available = check_dotnet()
-    moonsec_exists = MOONSEC_PATH.exists()
+# Toolchain probes only change on admin action; re-check at most every HEALTH_TTL
+_health_cache = {"t": 0, "v": None}
+
+def system_status(force=False):
+    """Return the (cached) .NET and Moonsec path status"""
+    now = time.monotonic()
+    if not force and _health_cache["v"] is not None and now - _health_cache["t"] < HEALTH_TTL:
+        return _health_cache["v"]
     
-    return jsonify({
+    if force:
+        check_dotnet.cache_clear()
+        # A running build refreshes the executable itself when it finishes
+        if not _build_lock.locked():
+            refresh_exe()
+    
+    moonsec_exists = MOONSEC_PATH.exists()
+    status = {
         "status": "ok",
-        "dotnet": dotnet_available,
+        "dotnet": check_dotnet(),
         "moonsec_path": str(MOONSEC_PATH),
         "moonsec_exists": moonsec_exists,
         "timestamp": os.path.getmtime(str(MOONSEC_PATH)) if moonsec_exists else 0
+    }
+    _health_cache.update(t=now, v=status)
+    return status
+
+@app.route('/health', methods=['GET'])
+def health():
+    """Health check endpoint"""
+    status = system_status(force=request.args.get('force') == '1')
+    pool = _worker_pool
+    
+    return jsonify({
+        **status,
+        "workers": pool.ping() if pool is not None else False,
+        "cache": {
+            "size": len(_result_cache),
+            "hits": _cache_stats["hits"],
+            "misses": _cache_stats["misses"]
+        }
     })
 
+def cache_key(content, disassembly, pretty):
+    digest = hashlib.blake2b(content.encode('utf-8'), digest_size=16).digest()
+    return digest, bool(disassembly), bool(pretty)
+
+def etag_for(key, filename):
+    """ETag for a result: input digest, flags, echoed filename and the producing build"""
+    digest, disassembly, pretty = key
+    name = hashlib.blake2b(str(filename).encode('utf-8'), digest_size=8).hexdigest()
+    return f"{digest.hex()}-{int(disassembly)}{int(pretty)}-{name}-{BUILD_STAMP:x}"
+
+class DeobfuscationError(Exception):
+    """Raised when the Moonsec tool fails on a job"""
+
+def run_stdio(exe_argv, command, content):
+    """Run the Moonsec tool once over stdin/stdout and return its output"""
+    cmd = exe_argv + [command, "-i", "-", "-o", "-"]
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("Running command: %s", ' '.join(cmd))
+    
+    result = subprocess.run(
+        cmd,
+        input=content.encode('utf-8'),
+        capture_output=True,
+        timeout=JOB_TIMEOUT,
+        close_fds=False
+    )
+    
+    stderr = result.stderr.decode('utf-8', 'ignore')
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("Return code: %s", result.returncode)
+        if stderr:
+            log.debug("STDERR: %s", stderr[:200])
+    
+    if result.returncode != 0:
+        error_msg = stderr.strip() or "Unknown error"
+        raise DeobfuscationError(f"Deobfuscation failed: {error_msg}")
+    
+    return result.stdout.decode('utf-8', 'ignore')
+
+_temp_files = None
+_temp_files_lock = threading.Lock()
+
+def temp_file_pool():
+    """Queue of reusable (input fd, input path, output path) slots, created on first use
+
+    The directory comes from mkdtemp (mode 0700, unpredictable name) and the
+    input files are created with O_EXCL|O_NOFOLLOW, so nothing else on the
+    box can plant or swap them.
+    """
+    global _temp_files
+    
+    with _temp_files_lock:
+        if _temp_files is None:
+            pool_dir = tempfile.mkdtemp(prefix="moonsec-", dir=TEMP_POOL_PARENT)
+            atexit.register(shutil.rmtree, pool_dir, ignore_errors=True)
+            
+            free = queue.Queue()
+            for i in range(TEMP_POOL_SIZE):
+                input_path = os.path.join(pool_dir, f"in_{i}.lua")
+                input_fd = os.open(input_path, os.O_RDWR | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0o600)
+                free.put((input_fd, input_path, input_path + ".output"))
+            _temp_files = free
+        return _temp_files
+
+def run_oneshot(exe_argv, command, content):
+    """Run the Moonsec tool once on a pooled temp file and return its output"""
+    free = temp_file_pool()
+    input_fd, input_path, output_path = free.get()
+    
+    try:
+        # Rewrite the input in place through the descriptor we created
+        os.ftruncate(input_fd, 0)
+        with open(input_fd, 'wb', closefd=False) as f:
+            f.seek(0)
+            f.write(content.encode('utf-8'))
+        
+        cmd = exe_argv + [command, "-i", input_path, "-o", output_path]
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Running command: %s", ' '.join(cmd))
+        
+        # Run deobfuscator
+        result = subprocess.run(
+            cmd,
+            capture_output=True,
+            text=True,
+            timeout=JOB_TIMEOUT,
+            encoding='utf-8',
+            errors='ignore',
+            close_fds=False
+        )
+        
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Return code: %s", result.returncode)
+            if result.stdout:
+                log.debug("STDOUT: %s", result.stdout[:200])
+            if result.stderr:
+                log.debug("STDERR: %s", result.stderr[:200])
+        
+        if result.returncode != 0:
+            error_msg = result.stderr.strip() if result.stderr else "Unknown error"
+            raise DeobfuscationError(f"Deobfuscation failed: {error_msg}")
+        
+        # Read output file; the tool must create it, see the cleanup below
+        try:
+            output_fd = os.open(output_path, os.O_RDONLY | os.O_NOFOLLOW)
+        except FileNotFoundError:
+            raise DeobfuscationError("Output file was not created")
+        
+        with open(output_fd, 'r', encoding='utf-8', errors='ignore') as f:
+            return f.read()
+    finally:
+        # Keep the input file for the next job, but remove the output so a
+        # run that writes nothing is reported instead of returning stale data
+        os.ftruncate(input_fd, 0)
+        try:
+            os.unlink(output_path)
+        except FileNotFoundError:
+            pass
+        free.put((input_fd, input_path, output_path))
+
+def run_moonsec(exe_argv, content, disassembly, pretty):
+    """Deobfuscate on a persistent worker, falling back to a one-shot run
+
+    Workers advertising `pretty` format the output themselves; otherwise
+    format_output() is applied here when requested.
+    """
+    pool = get_worker_pool(exe_argv)
+    if pool is None:
+        command = "-dis" if disassembly else "-dev"
+        if USE_STDIO:
+            output = run_stdio(exe_argv, command, content)
+        else:
+            output = run_oneshot(exe_argv, command, content)
+        return format_output(output, disassembly) if pretty else output
+    
+    native_pretty = pretty and "pretty" in pool.capabilities
+    flags = FLAG_DISASSEMBLY if disassembly else 0
+    if native_pretty:
+        flags |= FLAG_PRETTY
+    
+    status, output = pool.run(flags, content.encode('utf-8'))
+    output = output.decode('utf-8', 'ignore')
+    if status != 0:
+        raise DeobfuscationError(f"Deobfuscation failed: {output.strip() or 'Unknown error'}")
+    
+    if pretty and not native_pretty:
+        output = format_output(output, disassembly)
+    return output
+
+@app.errorhandler(RequestEntityTooLarge)
+def request_too_large(e):
+    return jsonify({
+        "success": False,
+        "error": f"Request body exceeds {MAX_REQUEST_BYTES} bytes"
+    }), 413
+
+def result_response(output_content, output_format, filename, etag):
+    """Encode a successful deobfuscation with orjson, streaming large results"""
+    if len(output_content) <= STREAM_THRESHOLD:
+        response = app.response_class(orjson.dumps({
+            "success": True,
+            "result": output_content,
+            "format": output_format,
+            "original_filename": filename
+        }), mimetype='application/json')
+        response.set_etag(etag)
+        return response
+    
+    def generate():
+        yield b'{"success":true,"format":' + orjson.dumps(output_format)
+        yield b',"original_filename":' + orjson.dumps(filename) + b',"result":"'
+        # JSON string escaping is per character, so chunks can be escaped independently
+        for start in range(0, len(output_content), STREAM_CHUNK):
+            yield orjson.dumps(output_content[start:start + STREAM_CHUNK])[1:-1]
+        yield b'"}'
+    
+    response = Response(stream_with_context(generate()), mimetype='application/json')
+    response.set_etag(etag)
+    return response
+
 @app.route('/deobfuscate', methods=['POST'])
 def deobfuscate():
     """Main deobfuscation endpoint"""
     try:
-        # Get request data
-        data = request.get_json()
+        # Get request data; orjson parses the raw body without Flask's copy
+        raw = request.get_data(cache=False)
+        if not raw:
+            return jsonify({
+                "success": False,
+                "error": "Empty request body"
+            }), 400
         
-        if not data or 'content' not in data:
+        try:
+            data = orjson.loads(raw)
+        except orjson.JSONDecodeError as e:
             return jsonify({
                 "success": False,
-                "error": "No content provided"
+                "error": f"Invalid JSON: {e}"
             }), 400
         
-        # Validate Moonsec path
-        if not MOONSEC_PATH.exists():
+        # Drop the raw body before the tool runs to bound peak memory
+        del raw
+        
+        if not isinstance(data, dict) or 'content' not in data:
             return jsonify({
                 "success": False,
-                "error": f"MoonsecDeobfuscator not found at: {MOONSEC_PATH}"
-            }), 500
+                "error": "No content provided"
+            }), 400
         
-        # Create temporary files
-        with tempfile.NamedTemporaryFile(mode='w', suffix='.lua', delete=False, encoding='utf-8') as f:
-            f.write(data['content'])
-            input_path = f.name
+        if not isinstance(data['content'], str):
+            return jsonify({
+                "success": False,
+                "error": "Content must be a string"
+            }), 400
         
-        output_path = input_path + ".output"
+        # A code point is at most four UTF-8 bytes, so only encode when it could matter
+        content = data['content']
+        if len(content) > MAX_LUA_BYTES // 4 and len(content.encode('utf-8')) > MAX_LUA_BYTES:
+            return jsonify({
+                "success": False,
+                "error": f"Content exceeds {MAX_LUA_BYTES} bytes"
+            }), 413
         
         try:
-            # Determine command
             disassembly = data.get('disassembly', False)
-            command = "-dis" if disassembly else "-dev"
-            
-            # Check if build is needed
-            if not BUILD_PATH.exists():
-                if not build_moonsec():
-                    return jsonify({
-                        "success": False,
-                        "error": "Failed to build Moonsec tool"
-                    }), 500
-            
-            # Find the executable
-            exe_path = None
-            possible_paths = [
-                BUILD_PATH / "MoonsecDeobfuscator.exe",  # Windows
-                BUILD_PATH / "MoonsecDeobfuscator",      # Linux/Mac
-                MOONSEC_PATH / "bin" / "Release" / "net8.0" / "MoonsecDeobfuscator.exe",
-                MOONSEC_PATH / "bin" / "Release" / "net8.0" / "MoonsecDeobfuscator"
-            ]
-            
-            for path in possible_paths:
-                if path.exists():
-                    exe_path = path
-                    break
+            pretty = data.get('pretty', True)
+            output_format = "disassembly" if disassembly else "bytecode"
+            filename = data.get('filename', 'unknown.lua')
             
-            if not exe_path:
-                # Try dotnet run as fallback
-                dll_path = BUILD_PATH / "MoonsecDeobfuscator.dll"
-                if dll_path.exists():
-                    cmd = ["dotnet", str(dll_path), command, "-i", input_path, "-o", output_path]
-                else:
-                    return jsonify({
-                        "success": False,
-                        "error": "Moonsec executable not found. Try building first."
-                    }), 500
-            else:
-                cmd = [str(exe_path), command, "-i", input_path, "-o", output_path]
+            # Wait out the startup build
+            if not BUILD_READY.wait(timeout=60):
+                return jsonify({
+                    "success": False,
+                    "error": "Moonsec tool is still building, try again shortly"
+                }), 503
             
-            print(f"Running command: {' '.join(cmd)}")
+            # Pick up an out-of-band rebuild before BUILD_STAMP goes into the ETag
+            exe_argv = get_exe_argv()
             
-            # Run deobfuscator
-            result = subprocess.run(
-                cmd,
-                capture_output=True,
-                text=True,
-                timeout=30,  # 30 second timeout
-                encoding='utf-8',
-                errors='ignore'
-            )
+            # The client already holds this result
+            key = cache_key(data['content'], disassembly, pretty)
+            etag = etag_for(key, filename)
+            # Weak comparison, as RFC 9110 requires for If-None-Match
+            if request.if_none_match.contains_weak(etag):
+                response = app.response_class(status=304)
+                response.set_etag(etag)
+                return response
             
-            print(f"Return code: {result.returncode}")
-            if result.stdout:
-                print(f"STDOUT: {result.stdout[:200]}")
-            if result.stderr:
-                print(f"STDERR: {result.stderr[:200]}")
+            # Deobfuscation is a pure function of the input, so serve repeats from cache
+            cacheable = len(data['content']) <= CACHE_MAX_CONTENT
+            if cacheable:
+                with _result_cache_lock:
+                    cached = _result_cache.get(key)
+                    _cache_stats["hits" if cached is not None else "misses"] += 1
+                
+                if cached is not None:
+                    output_content, output_format = cached
+                    return result_response(output_content, output_format, filename, etag)
             
-            if result.returncode != 0:
-                error_msg = result.stderr.strip() if result.stderr else "Unknown error"
+            # Fail fast rather than spawning a tool that can't run
+            if not _READY:
                 return jsonify({
                     "success": False,
-                    "error": f"Deobfuscation failed: {error_msg}"
-                }), 500
+                    "error": _READY_MSG
+                }), 503
             
-            # Read output file
-            if os.path.exists(output_path):
-                with open(output_path, 'r', encoding='utf-8', errors='ignore') as f:
-                    output_content = f.read()
-                
-                # Format output if requested
-                if data.get('pretty', True):
-                    output_content = format_output(output_content, disassembly)
-                
-                return jsonify({
-                    "success": True,
-                    "result": output_content,
-                    "format": "disassembly" if disassembly else "bytecode",
-                    "original_filename": data.get('filename', 'unknown.lua')
-                })
-            else:
-                return jsonify({
-                    "success": False,
-                    "error": "Output file was not created"
-                }), 500
+            output_content = run_moonsec(exe_argv, data['content'], disassembly, pretty)
+            
+            if cacheable:
+                with _result_cache_lock:
+                    _result_cache[key] = (output_content, output_format)
+            
+            return result_response(output_content, output_format, filename, etag)
                 
+        except DeobfuscationError as e:
+            return jsonify({
+                "success": False,
+                "error": str(e)
+            }), 500
         except subprocess.TimeoutExpired:
             return jsonify({
                 "success": False,
-                "error": "Process timed out after 30 seconds"
+                "error": f"Process timed out after {JOB_TIMEOUT} seconds"
             }), 500
         except Exception as e:
             return jsonify({
                 "success": False,
                 "error": f"Processing error: {str(e)}"
             }), 500
-        finally:
-            # Cleanup temporary files
-            try:
-                if os.path.exists(input_path):
-                    os.unlink(input_path)
-                if os.path.exists(output_path):
-                    os.unlink(output_path)
-            except:
-                pass
                 
+    except RequestEntityTooLarge:
+        raise
     except Exception as e:
         return jsonify({
             "success": False,
             "error": f"Server error: {str(e)}"
         }), 500
 
+@app.route('/rebuild', methods=['POST'])
+def rebuild():
+    """Rebuild the Moonsec tool; workers restart if the binaries changed"""
+    try:
+        built = build_moonsec(force=True, clean=request.args.get('clean') == '1')
+    except BuildInProgress as e:
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 409
+    
+    if not built:
+        return jsonify({
+            "success": False,
+            "error": "Failed to build Moonsec tool"
+        }), 500
+    
+    return jsonify({
+        "success": True,
+        "executable": EXE_ARGV
+    })
+
+@app.route('/cache/clear', methods=['POST'])
+def clear_cache():
+    """Drop all memoized deobfuscation results"""
+    with _result_cache_lock:
+        cleared = len(_result_cache)
+        _result_cache.clear()
+    
+    return jsonify({
+        "success": True,
+        "cleared": cleared
+    })
+
 def format_output(content, is_disassembly):
     """Format output for better readability"""
     if not content:
@@ -226,44 +912,43 @@ def format_output(content, is_disassembly):
     
     if is_disassembly:
         # Format disassembly
-        lines = content.split('\n')
-        formatted = []
-        for line in lines:
-            line = line.rstrip()
-            if line:
-                formatted.append(line)
-        return '\n'.join(formatted)
+        formatted = content
     else:
         # Format Lua/bytecode
-        # Add newlines after semicolons and braces
+        # Add newlines after semicolons and braces. Chained str.replace runs
+        # as a C-level memchr scan and beats any per-character Python loop.
         formatted = content.replace(';', ';\n')
         formatted = formatted.replace('{', '{\n')
         formatted = formatted.replace('}', '\n}')
-        
-        # Remove excessive blank lines
-        lines = formatted.split('\n')
-        lines = [line.rstrip() for line in lines if line.strip()]
-        return '\n'.join(lines)
+    
+    # Strip trailing whitespace and drop blank lines in one pass; a line is
+    # blank exactly when its rstrip() is empty, so strip() isn't needed too.
+    # filter/map keep the per-line loop in C.
+    return '\n'.join(filter(None, map(str.rstrip, formatted.split('\n'))))
 
-@app.route('/test', methods=['GET'])
-def test():
-    """Test endpoint with sample Lua code"""
-    sample_lua = '''local chars = { "H", "e", "l", "l", "o ", "W", "o", "r", "l", "d", "!" }
+_SAMPLE_LUA = '''local chars = { "H", "e", "l", "l", "o ", "W", "o", "r", "l", "d", "!" }
 local result = ""
 for i = 1, #chars do
     result = result .. chars[i]
 end
 print(result)'''
-    
-    return jsonify({
-        "test": "Moonsec API is working",
-        "sample": sample_lua,
-        "endpoints": {
-            "POST /deobfuscate": "Deobfuscate Lua code",
-            "GET /health": "Check system health",
-            "GET /test": "This test endpoint"
-        }
-    })
+
+_TEST_BODY = orjson.dumps({
+    "test": "Moonsec API is working",
+    "sample": _SAMPLE_LUA,
+    "endpoints": {
+        "POST /deobfuscate": "Deobfuscate Lua code",
+        "GET /health": "Check system health",
+        "POST /cache/clear": "Clear cached results",
+        "POST /rebuild": "Rebuild the Moonsec tool (?clean=1 for a full rebuild)",
+        "GET /test": "This test endpoint"
+    }
+})
+
+@app.route('/test', methods=['GET'])
+def test():
+    """Test endpoint with sample Lua code"""
+    return Response(_TEST_BODY, mimetype='application/json')
 
 if __name__ == '__main__':
     print("🚀 Starting Moonsec Deobfuscator Server")
@@ -286,21 +971,26 @@ if __name__ == '__main__':
     print("✅ .NET SDK is available")
     print(f"✅ Moonsec path: {MOONSEC_PATH}")
     
-    # Build in background thread
-    def background_build():
-        build_moonsec()
-    
-    build_thread = threading.Thread(target=background_build, daemon=True)
-    build_thread.start()
-    
+    # The build was already started in the background on import
     print("🔨 Building Moonsec in background...")
     print("🌐 Server starting on http://127.0.0.1:5000")
     print("=" * 50)
     
     # Start the server
-    app.run(
-        host='127.0.0.1',
-        port=5000,
-        debug=False,
-        threaded=True
-    )
\ No newline at end of file
+    if os.environ.get('FLASK_DEV'):
+        app.run(
+            host='127.0.0.1',
+            port=5000,
+            debug=False,
+            threaded=True
+        )
+    else:
+        from waitress import serve
+        serve(
+            app,
+            host='127.0.0.1',
+            port=5000,
+            threads=16,
+            connection_limit=200,
+            channel_timeout=60
+        )
\ No newline at end of file